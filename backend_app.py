@@ -1,12 +1,22 @@
+import asyncio
+import gzip
+import hashlib
+import itertools
 import os
-import math
+import sys
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from typing import Optional, List, Dict
 
+import numpy as np
+import orjson
 import pandas as pd
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import HTMLResponse, Response
 from pathlib import Path
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
 
 # ------------------------------------------------------------
 # קונפיג – נתיבי פרויקט (יחסיים)
@@ -26,10 +36,81 @@ NO_CACHE_HEADERS = {
     "Expires": "0",
 }
 
+# לתשובות עם ETag: הדפדפן רשאי לשמור עותק אך חייב לאמת אותו מול השרת בכל בקשה (304 אם לא השתנה)
+REVALIDATE_HEADERS = {
+    "Cache-Control": "no-cache, must-revalidate",
+    "Pragma": "no-cache",
+    "Expires": "0",
+}
+
+# קאש בזיכרון של גוף התשובה (JSON מוכן כ-bytes, רגיל ודחוס gzip) – נבנה מחדש רק כשהקובץ משתנה (path, mtime, size)
+# "dirty" מסומן ע"י ה-watcher כשקובץ ה-CSV משתנה; כל עוד הוא False מגישים מהקאש בלי לגשת לדיסק
+# "seq" – מספר הבנייה שממנה הגיע התוכן, כדי שבנייה ישנה שמסתיימת מאוחר לא תדרוס חדשה
+_CACHE = {"key": None, "body": None, "body_gz": None, "etag": None, "dirty": True, "seq": 0}
+
+# בניות שרצות כרגע לפי key (single-flight): בקשות מקבילות לאותה גרסת קובץ ממתינות לאותה בנייה
+_INFLIGHT: Dict[tuple, asyncio.Task] = {}
+_BUILD_SEQ = itertools.count(1)
+
+# גרסת העיבוד של load_dataframe – חלק משם קובץ ה-Parquet המעובד.
+# יש להעלות אותה בכל שינוי בעיבוד (שמות עמודות, טיפוסים, כללי סחירות וכו'),
+# כדי שקבצי Parquet שנבנו בגרסה קודמת לא ייטענו.
+_PARQUET_VERSION = 1
+
+# קובץ ה-SPA נטען לזיכרון פעם אחת בעלייה (None אם חסר) – אין גישה לדיסק בהגשה
+SPA_BYTES = FRONTEND_FILE.read_bytes() if FRONTEND_FILE.exists() else None
+SPA_ETAG = f'"{hashlib.md5(SPA_BYTES).hexdigest()}"' if SPA_BYTES is not None else None
+
+# ה-Observer של watchdog שעוקב אחרי תיקיית output (רץ רק בזמן חיי האפליקציה)
+_WATCHER = {"observer": None}
+
+# ------------------------------------------------------------
+# מעקב אחרי שינויים בקובץ ה-CSV
+# ------------------------------------------------------------
+class CsvChangeHandler(FileSystemEventHandler):
+    """מסמן את הקאש כלא-עדכני בכל יצירה/שינוי/החלפה/מחיקה של קובץ ה-CSV הקבוע."""
+
+    def _mark(self, *paths):
+        if any(os.path.basename(p) == FIXED_CSV_NAME for p in paths if p):
+            _CACHE["dirty"] = True
+
+    def on_created(self, event):
+        self._mark(event.src_path)
+
+    def on_modified(self, event):
+        self._mark(event.src_path)
+
+    def on_moved(self, event):
+        self._mark(event.src_path, event.dest_path)
+
+    def on_deleted(self, event):
+        self._mark(event.src_path)
+
+def is_watching() -> bool:
+    observer = _WATCHER["observer"]
+    return observer is not None and observer.is_alive()
+
+@asynccontextmanager
+async def lifespan(app):
+    observer = None
+    if OUTPUT_DIR.is_dir():
+        observer = Observer()
+        observer.schedule(CsvChangeHandler(), str(OUTPUT_DIR), recursive=False)
+        observer.start()
+        _WATCHER["observer"] = observer
+        _CACHE["dirty"] = True
+    try:
+        yield
+    finally:
+        _WATCHER["observer"] = None
+        if observer is not None:
+            observer.stop()
+            observer.join()
+
 # ------------------------------------------------------------
 # FastAPI
 # ------------------------------------------------------------
-app = FastAPI(title="מרכיבי תשואה – Dashboard API v2.1")
+app = FastAPI(title="מרכיבי תשואה – Dashboard API v2.1", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -41,27 +122,36 @@ app.add_middleware(
 @app.middleware("http")
 async def no_cache_middleware(request, call_next):
     response = await call_next(request)
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Pragma"] = "no-cache"
-    response.headers["Expires"] = "0"
+    # ברירת מחדל בלבד – לא דורסים כותרות שה-endpoint קבע (למשל ETag + revalidate ב-/api/data)
+    for name, value in NO_CACHE_HEADERS.items():
+        response.headers.setdefault(name, value)
     return response
 
 # ------------------------------------------------------------
 # פונקציות עזר
 # ------------------------------------------------------------
-def clean_nan_inf(value):
-    if value is None:
-        return None
-    if isinstance(value, float):
-        if math.isnan(value):
-            return None
-        if value == math.inf or value == -math.inf:
-            return None
-    return value
-
-def clean_row(row: dict) -> dict:
-    return {k: clean_nan_inf(v) for k, v in row.items()}
+def column_to_objects(s: pd.Series) -> np.ndarray:
+    """
+    ממיר עמודה למערך object שבו כל ערך חסר (NaN/NA/INF) הוא None.
+    הניקוי נעשה וקטורית על כל העמודה בבת אחת, ולא תא-תא.
+    """
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        # עמודה קטגוריאלית – מחרוזת אחת (interned) לכל קטגוריה, משותפת לכל השורות.
+        # תא None בסוף המערך: קוד -1 (ערך חסר) נופל עליו, גם כשאין אף קטגוריה
+        cats = np.array([sys.intern(c) if isinstance(c, str) else c for c in s.cat.categories] + [None], dtype=object)
+        return cats.take(s.cat.codes.to_numpy())
+    if pd.api.types.is_float_dtype(s.dtype):
+        arr = s.to_numpy(dtype="float64", na_value=np.nan)
+        finite = np.isfinite(arr)
+        out = arr.astype(object)
+        # במקרה הנפוץ (עמודה ללא NaN/INF) מדלגים על ההשמה הממוסכת
+        if not finite.all():
+            out[~finite] = None
+        return out
+    # Int64 / string: מעבר יחיד שממיר ישר ל-object ושם None במקום NA
+    return s.to_numpy(dtype=object, na_value=None)
 
+@lru_cache(maxsize=None)
 def classify_liquidity_from_category(hebrew_category: Optional[str]) -> Optional[str]:
     """
     כללי הסחירות:
@@ -77,36 +167,174 @@ def classify_liquidity_from_category(hebrew_category: Optional[str]) -> Optional
 # ------------------------------------------------------------
 # ROOT – מגיש את ה-SPA
 # ------------------------------------------------------------
-@app.get("/", response_class=FileResponse)
-def root():
-    if not os.path.exists(FRONTEND_FILE):
+@app.get("/", response_class=HTMLResponse)
+async def root(request: Request):
+    if SPA_BYTES is None:
         raise HTTPException(
             status_code=500,
             detail=f"לא נמצא קובץ SPA: {FRONTEND_FILE}",
         )
-    return FileResponse(FRONTEND_FILE, headers=NO_CACHE_HEADERS)
+    headers = {**REVALIDATE_HEADERS, "ETag": SPA_ETAG}
+    if etag_matches(request.headers.get("if-none-match"), SPA_ETAG):
+        return Response(status_code=304, headers=headers)
+    return Response(content=SPA_BYTES, media_type="text/html; charset=utf-8", headers=headers)
 
 # ------------------------------------------------------------
 # /api/data – טוען את הנתונים, מנקה אותם ומחזיר JSON תקין
 # ------------------------------------------------------------
 @app.get("/api/data")
-def api_data():
+async def api_data(request: Request):
     """
-    מחזיר את כל הרשומות + meta בצורה אחידה.
+    מחזיר את כל הרשומות (columns + data) + meta בצורה אחידה.
     קורא תמיד מקובץ קבוע: all_companies_all_yields.csv בתיקיית output.
     """
 
     csv_path = OUTPUT_DIR / FIXED_CSV_NAME
 
-    if not csv_path.exists():
+    # כשה-watcher פעיל, לא דווח על שינוי ואין בנייה פתוחה – אין צורך אפילו ב-stat
+    # לקובץ, והבקשה מוגשת כולה מתוך ה-event loop. בלי watcher (למשל תיקייה שלא
+    # הייתה קיימת בעלייה) בודקים את הקובץ בכל בקשה.
+    if _CACHE["dirty"] or _INFLIGHT or not is_watching():
+        await refresh_cache(csv_path)
+
+    use_gzip = accepts_gzip(request.headers.get("accept-encoding"))
+
+    # לכל ייצוג (רגיל / gzip) ETag משלו
+    etag = _CACHE["etag"]
+    if use_gzip:
+        etag = etag[:-1] + '-gz"'
+    headers = {**REVALIDATE_HEADERS, "ETag": etag, "Vary": "Accept-Encoding"}
+
+    # הלקוח כבר מחזיק את הגרסה העדכנית – תשובה ריקה
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    # החזרת JSON תקין לחלוטין (ללא NaN/INF) – מוגש כמו שהוא, ללא סריאליזציה או דחיסה נוספת
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=_CACHE["body_gz"], media_type="application/json", headers=headers)
+    return Response(content=_CACHE["body"], media_type="application/json", headers=headers)
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    """
+    האם כותרת Accept-Encoding מתירה gzip: q>0 עבור gzip, או עבור "*" אם gzip לא צוין.
+    שמות הקידוד אינם תלויי רישיות; q לא תקין נחשב כסירוב.
+    """
+    if not accept_encoding:
+        return False
+    qvalues = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = q
+    q = qvalues.get("gzip", qvalues.get("*", 0.0))
+    return q > 0
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """השוואה חלשה (מתעלמת מ-W/) של כותרת If-None-Match מול ה-ETag הנוכחי."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    return etag in tags
+
+async def refresh_cache(csv_path: Path):
+    """
+    מוודא שהקאש תואם לקובץ הנוכחי (path, mtime, size), ובונה אותו מחדש אם לא.
+    לכל key רצה בנייה אחת בלבד: בקשות שמגיעות בזמן בנייה ממתינות לאותו Task
+    במקום להריץ עוד בנייה של pandas במקביל.
+    """
+    # מאפסים את הדגל לפני ה-stat, כך ששינוי שמגיע תוך כדי בנייה יסמן את הקאש מחדש
+    _CACHE["dirty"] = False
+    try:
+        if not csv_path.exists():
+            raise HTTPException(
+                status_code=404,
+                detail=f"לא נמצא קובץ CSV: {csv_path}",
+            )
+
+        st = csv_path.stat()
+        key = (str(csv_path), st.st_mtime_ns, st.st_size)
+
+        if _CACHE["key"] == key:
+            return
+
+        task = _INFLIGHT.get(key)
+        if task is None:
+            task = asyncio.create_task(rebuild_cache(csv_path, key, st, next(_BUILD_SEQ)))
+            _INFLIGHT[key] = task
+            task.add_done_callback(lambda _: _INFLIGHT.pop(key, None))
+
+        # shield – ניתוק של לקוח אחד לא מבטל את הבנייה עבור כל הממתינים
+        await asyncio.shield(task)
+    except Exception:
+        _CACHE["dirty"] = True
+        raise
+
+async def rebuild_cache(csv_path: Path, key: tuple, st: os.stat_result, seq: int):
+    """
+    בונה את גוף התשובה (JSON + gzip + ETag) ושומר אותו בקאש.
+    עבודת ה-pandas/JSON/gzip/hash רצה ב-thread נפרד כדי לא לחסום את ה-event loop.
+    """
+    try:
+        body = await asyncio.to_thread(build_payload, csv_path, st)
+        body_gz = await asyncio.to_thread(gzip.compress, body, compresslevel=6)
+        # ETag לפי תוכן הגוף בפועל – שינוי בעיבוד או בפורמט התשובה משנה אותו גם כשה-CSV זהה
+        digest = (await asyncio.to_thread(hashlib.md5, body)).hexdigest()
+    except BaseException:
+        _CACHE["dirty"] = True
+        raise
+
+    if seq > _CACHE["seq"]:
+        _CACHE["body"] = body
+        _CACHE["body_gz"] = body_gz
+        _CACHE["etag"] = f'"{digest}"'
+        _CACHE["key"] = key
+        _CACHE["seq"] = seq
+
+# ------------------------------------------------------------
+# בניית הנתונים מתוך קובץ ה-CSV
+# ------------------------------------------------------------
+def load_dataframe(csv_path: Path, st: os.stat_result) -> pd.DataFrame:
+    """
+    מחזיר DataFrame מעובד (שמות עמודות באנגלית, טיפוסים, סחירות מנורמלת).
+    אם כבר קיים קובץ Parquet מעובד עבור אותה גרסת CSV (mtime, size) ואותה
+    גרסת עיבוד (_PARQUET_VERSION) – נטען ממנו ומדלגים על כל שלבי הקריאה והעיבוד.
+    """
+
+    parquet_path = csv_path.parent / f".cache_v{_PARQUET_VERSION}_{st.st_mtime_ns}_{st.st_size}.parquet"
+    if parquet_path.exists():
+        try:
+            return pd.read_parquet(parquet_path)
+        except (OSError, ValueError):
+            pass  # קובץ קאש פגום – נבנה מחדש מה-CSV
+
+    # קריאה עם קידוד – מנוע pyarrow (מרובה-תהליכונים); העמודות המספריות מגיעות כבר
+    # מטיפוס מספרי, אלא אם יש בהן תא לא תקין (למשל "-" או "#DIV/0!") – ראו המרות הטיפוסים
+    try:
+        df = pd.read_csv(
+            csv_path,
+            encoding="utf-8-sig",
+            engine="pyarrow",
+            dtype_backend="numpy_nullable",
+        )
+    except ValueError as e:
         raise HTTPException(
-            status_code=404,
-            detail=f"לא נמצא קובץ CSV: {csv_path}",
+            status_code=500,
+            detail=f"שגיאה בקריאת קובץ ה-CSV: {e}",
         )
 
-    # קריאה עם קידוד
-    df = pd.read_csv(csv_path, encoding="utf-8-sig")
-
     # העמודות שמצופות בקובץ
     # שמרנו על תאימות לאחור: "סחירות" אינה חובה; אם חסרה – נחשב אותה מתוך "אפיק השקעה".
     required_cols = [
@@ -117,7 +345,6 @@ def api_data():
         "חברה מקוצר",
         "סוג חיסכון",
         "סוג קופה",
-        "סוג מסלול",
         "ח.פ",
         "שנה",
         "רבעון",
@@ -133,15 +360,19 @@ def api_data():
             detail=f"עמודות חסרות בקובץ: {', '.join(missing)}",
         )
 
+    # סיווג הסחירות לפי "אפיק השקעה" – פעם אחת לכל ערך ייחודי, ואז map וקטורי על כל העמודה
+    mapping = {c: classify_liquidity_from_category(c) for c in df["אפיק השקעה"].unique()}
+    computed = df["אפיק השקעה"].map(mapping)
+
     # אם אין עמודת "סחירות" בקובץ – נחשב אותה לפי הכלל
     if "סחירות" not in df.columns:
-        df["סחירות"] = df["אפיק השקעה"].apply(classify_liquidity_from_category)
+        df["סחירות"] = computed
     else:
-        # מנרמלים לכתיב אחיד ("סחיר"/"לא סחיר") למקרה שיש וריאציות
-        df["סחירות"] = df["סחירות"].apply(
-            lambda v: classify_liquidity_from_category(df.loc[df.index[df["סחירות"] == v], "אפיק השקעה"].iloc[0])
-            if v not in ("סחיר", "לא סחיר") else v
-        )
+        # מנרמלים לכתיב אחיד ("סחיר"/"לא סחיר") למקרה שיש וריאציות –
+        # ערך לא תקין (או חסר) מוחלף בסיווג לפי "אפיק השקעה" של אותה שורה
+        s = df["סחירות"]
+        valid = s.isin(("סחיר", "לא סחיר"))
+        df["סחירות"] = s.where(valid, computed)
 
     # מיפוי שמות לעברית → אנגלית
     rename_map = {
@@ -163,29 +394,58 @@ def api_data():
 
     df = df.rename(columns=rename_map)
 
-    # המרות טיפוסים
+    # המרות טיפוסים – רק לעמודות שלא הגיעו מהטיפוס הצפוי; תא לא מספרי הופך ל-None
     for col in ["year", "quarter"]:
-        df[col] = pd.to_numeric(df[col], errors="coerce").astype("Int64")
+        if not pd.api.types.is_integer_dtype(df[col].dtype):
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype("Int64")
 
     for col in ["contribution", "weight", "yield"]:
-        df[col] = pd.to_numeric(df[col], errors="coerce")
+        if not pd.api.types.is_float_dtype(df[col].dtype):
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype("Float64")
 
-    # המרת INF → NaN
-    df = df.replace([math.inf, -math.inf], pd.NA)
+    # עמודות טקסט עם ערכים חוזרים → category (חוסך זיכרון ומחרוזות כפולות)
+    for col in ["category", "company", "company_short", "saving_type", "fund_type", "track_name", "liquidity"]:
+        df[col] = df[col].astype("category")
+
+    # שמירת ה-DataFrame המעובד כ-Parquet (כתיבה אטומית) ומחיקת קבצי קאש ישנים;
+    # כישלון בכתיבה (למשל תיקייה לקריאה בלבד) אינו מפיל את הבקשה
+    try:
+        for pattern in (".cache_*.parquet", ".cache_*.parquet.tmp"):
+            for old in csv_path.parent.glob(pattern):
+                old.unlink()
+        tmp_path = parquet_path.with_name(parquet_path.name + ".tmp")
+        df.to_parquet(tmp_path)
+        tmp_path.replace(parquet_path)
+    except (OSError, ValueError, TypeError):
+        pass  # כולל שגיאות המרה של Arrow (ArrowInvalid / ArrowTypeError)
+
+    return df
+
+# ------------------------------------------------------------
+# בניית גוף התשובה (JSON)
+# ------------------------------------------------------------
+def build_payload(csv_path: Path, st: os.stat_result) -> bytes:
+    """
+    מחזיר את גוף התשובה של /api/data (status + columns + data + meta)
+    כ-JSON מקודד מראש ב-orjson. הרשומות בפורמט split: רשימת עמודות אחת
+    ושורות כמערכים, בלי לחזור על שמות העמודות בכל שורה.
+    השורות נבנות רק כאן (פעם אחת לכל שינוי בקובץ) ואינן נשמרות –
+    בקאש נשמרים רק ה-bytes המוכנים.
+    """
 
-    # המרת NaN ל-None
-    df = df.where(df.notnull(), None)
+    df = load_dataframe(csv_path, st)
 
-    # הפיכת הרשומות למילונים
-    raw_rows = df.to_dict(orient="records")
+    # ניקוי NaN/INF → None עמודה-עמודה
+    cols = {c: column_to_objects(df[c]) for c in df.columns}
 
-    # ניקוי NaN/INF בכל שורה
-    rows: List[Dict] = [clean_row(r) for r in raw_rows]
+    # שורות כטאפלים מתוך מערכי העמודות (orjson מקודד טאפל כמערך JSON)
+    columns = list(cols)
+    data: List[tuple] = list(zip(*cols.values()))
 
-    # meta עבור פילטרים ותצוגה
+    # meta עבור פילטרים ותצוגה – ערכים ייחודיים ישירות מעמודות ה-DataFrame
     def unique_sorted(col: str):
-        vals = sorted({r[col] for r in rows if r.get(col) is not None})
-        return vals
+        vals = df[col].dropna().unique()
+        return sorted(vals.tolist())
 
     years = unique_sorted("year")
     meta = {
@@ -199,17 +459,17 @@ def api_data():
         "years": years,
         "min_year": years[0] if years else None,
         "max_year": years[-1] if years else None,
-        "total_rows": len(rows),
+        "total_rows": len(df),
     }
 
-    # החזרת JSON תקין לחלוטין (ללא NaN/INF)
-    return JSONResponse(
+    return orjson.dumps(
         {
             "status": "ok",
-            "rows": rows,
+            "columns": columns,
+            "data": data,
             "meta": meta,
         },
-        headers=NO_CACHE_HEADERS,
+        option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS,
     )
 
 # ------------------------------------------------------------
@@ -217,4 +477,5 @@ def api_data():
 # ------------------------------------------------------------
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("backend_app:app", host="127.0.0.1", port=8010, reload=True)
+    # ה-SPA נטען לזיכרון בעלייה – לכן גם שינוי בקובץ ה-HTML מפעיל reload
+    uvicorn.run("backend_app:app", host="127.0.0.1", port=8010, reload=True, reload_includes=["*.html"])